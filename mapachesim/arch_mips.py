@@ -2,13 +2,17 @@
 
 import string
 
-from helpers import sign_extend, bit_select, decimalstr_to_int
+from helpers import sign_extend, decimalstr_to_int
 from helpers import ExecutionError, ExecutionComplete
 from isa import IsaDefinition
 from assembler import Assembler
 
+_u32 = 0xffffffff  # every instruction masks its results with this to stay within 32 bits
+
 class Mips(IsaDefinition):
     ''' MIPS Instruction Set Definition. '''
+    __slots__ = ('R', 'PC', 'HI', 'LO')  # the registers made below, for fast attribute access
+
     def __init__(self):
         super().__init__()
         mips_rnames = {
@@ -25,16 +29,20 @@ class Mips(IsaDefinition):
         self.make_register('HI', 32)
         self.make_register('LO', 32)
 
-        jumps = 'j jal jr jalr beq'.split()
-        self.jumps = set(getattr(self, f'instruction_{jump}') for jump in jumps)
+        for jump in 'j jal jr jalr beq'.split():
+            getattr(self, f'instruction_{jump}').__func__.is_branch = True
         self.endian = 'big'
         self.assembler = Assembler(self)
 
-    def finalize_execution(self, decoded_instruction):
-        ifunction, ifields = decoded_instruction
+    def execute(self, decoded_instr):
+        '''Execute a decoded instruction.  This replaces the base class version (which clips
+           every register after each instruction), so each instruction is responsible for masking
+           its results with _u32 and for updating the PC: "self.PC += 4" at the end of anything
+           that is not listed as a branch in __init__.'''
+        ifunction, ifield = decoded_instr
+        ireturn = ifunction(ifield)
         self.R[0] = 0  # keep regisiter 0 value as zero
-        if ifunction not in self.jumps:
-            self.PC = self.PC + 4
+        return ireturn
 
     def reset_registers(self):
         super().reset_registers()
@@ -74,27 +82,33 @@ class Mips(IsaDefinition):
 
     def instruction_sll(self, ifield):
         'shift left logical : 000000 ----- ttttt ddddd hhhhh 000000: sll $d $t !h'
-        self.R[ifield.d] = self.R[ifield.t] << ifield.h
+        self.R[ifield.d] = (self.R[ifield.t] << ifield.h) & _u32
+        self.PC += 4
 
     def instruction_srl(self, ifield):
         'shift right logical : 000000 ----- ttttt ddddd hhhhh 000010: srl $d $t !h'
         self.R[ifield.d] = self.R[ifield.t] >> ifield.h
+        self.PC += 4
 
     def instruction_sra(self, ifield):
         'shift right arithmetic : 000000 ----- ttttt ddddd hhhhh 000011: sra $d $t !h'
-        self.R[ifield.d] = sign_extend(self.R[ifield.t],32) >> ifield.h
+        self.R[ifield.d] = (sign_extend(self.R[ifield.t],32) >> ifield.h) & _u32
+        self.PC += 4
 
     def instruction_sllv(self, ifield):
         'shift left logical variable : 000000 sssss ttttt ddddd ----- 000100: sllv $d $t $s'
-        self.R[ifield.d] = self.R[ifield.t] << self.R[ifield.s]
+        self.R[ifield.d] = (self.R[ifield.t] << (self.R[ifield.s] & 31)) & _u32
+        self.PC += 4
 
     def instruction_srlv(self, ifield):
         'shift right logical variable : 000000 sssss ttttt ddddd ----- 000110: srlv $d $t $s'
-        self.R[ifield.d] = self.R[ifield.t] >> self.R[ifield.s]
+        self.R[ifield.d] = self.R[ifield.t] >> (self.R[ifield.s] & 31)
+        self.PC += 4
 
     def instruction_srav(self, ifield):
         'shift right arithmetic variable : 000000 sssss ttttt ddddd ----- 000111: srav $d $t $s'
-        self.R[ifield.d] = sign_extend(self.R[ifield.t],32) >> self.R[ifield.s]
+        self.R[ifield.d] = (sign_extend(self.R[ifield.t],32) >> (self.R[ifield.s] & 31)) & _u32
+        self.PC += 4
 
     def instruction_jr(self, ifield):
         'jump register : 000000 sssss ----- ----- ----- 001000: jr $s'
@@ -106,7 +120,7 @@ class Mips(IsaDefinition):
         self.invalid_when(self.R[ifield.s] % 4 != 0, 'jalr: R[$rs] must be a multiple of 4')
         self.invalid_when(ifield.s == ifield.d, 'jalr: $rs and $rd must be different registers')
         tmp = self.R[ifield.s]
-        self.R[ifield.d] = self.PC + 4
+        self.R[ifield.d] = (self.PC + 4) & _u32
         self.PC = tmp
 
     def instruction_syscall(self, ifield):
@@ -139,7 +153,7 @@ class Mips(IsaDefinition):
                 raise ExecutionError('syscall read end-of-file')
             input_int = decimalstr_to_int(input_str)
             if input_int:
-                self.R[v0] = input_int
+                self.R[v0] = input_int & _u32
             else:
                 raise ExecutionError('invalid integer read during system call')
 
@@ -147,37 +161,40 @@ class Mips(IsaDefinition):
             raise NotImplementedError('read string')
 
         elif self.R[v0] == 10:  # exit
+            self.PC += 4
             return ExecutionComplete
 
         else:
             self.invalid_when(True, f'syscall: invalid system call service (v0={self.R[v0]})')
+        self.PC += 4
 
     def instruction_mflo(self, ifield):
         'move from lo : 000000 ----- ----- ddddd ----- 010010: mflo $d'
         self.R[ifield.d] = self.LO
+        self.PC += 4
 
     def instruction_mult(self, ifield):
         'multiply : 000000 sssss ttttt ----- ----- 011000: mult $s $t'
-        result = self.R[ifield.s] * self.R[ifield.t]
-        self.LO = result
-        self.HI = result>>32
+        result = sign_extend(self.R[ifield.s], 32) * sign_extend(self.R[ifield.t], 32)
+        self.LO = result & _u32
+        self.HI = (result>>32) & _u32
+        self.PC += 4
 
     def instruction_add(self, ifield):
         'add : 000000 sssss ttttt ddddd ----- 100000: add $d $s $t'
-        self.R[ifield.d] = self.R[ifield.s] + self.R[ifield.t] 
+        self.R[ifield.d] = (self.R[ifield.s] + self.R[ifield.t]) & _u32
+        self.PC += 4
 
     # J-format Instructions
 
     def instruction_j(self, ifield):
         'jump : 000010 aaaaaaaaaaaaaaaaaaaaaaaaaa : j @a'
-        upper_bits = bit_select(self.PC + 4, 31, 28)
-        self.PC = upper_bits + (ifield.a << 2)
+        self.PC = ((self.PC + 4) & 0xf0000000) | (ifield.a << 2)
 
     def instruction_jal(self, ifield):
         'jump and link : 000011 aaaaaaaaaaaaaaaaaaaaaaaaaa : jal @a'
-        self.R[31] = self.PC + 4
-        upper_bits = bit_select(self.PC + 4, 31, 28)
-        self.PC = upper_bits + (ifield.a << 2)
+        self.R[31] = (self.PC + 4) & _u32
+        self.PC = ((self.PC + 4) & 0xf0000000) | (ifield.a << 2)
 
     # I-format Instructions
 
@@ -193,36 +210,41 @@ class Mips(IsaDefinition):
         # TODO: this should be PC-relative addressing! started above, but using absolute for now
         newpc = self.PC + 4
         if self.R[ifield.s] == self.R[ifield.t]:
-            upper_bits = bit_select(self.PC + 4, 31, 18)
-            newpc = upper_bits + (ifield.a << 2)
+            newpc = ((self.PC + 4) & 0xfffc0000) | (ifield.a << 2)
         self.PC = newpc
 
     def instruction_addi(self, ifield):
         'add immediate : 001000 sssss ttttt iiiiiiiiiiiiiiii : addi $t $s !i'
-        self.R[ifield.t] = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        self.R[ifield.t] = (self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)) & _u32
+        self.PC += 4
 
     def instruction_addiu(self, ifield):
         'add immediate unsigned : 001001 sssss ttttt iiiiiiiiiiiiiiii : addiu $t $s !i'
-        self.R[ifield.t] = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        self.R[ifield.t] = (self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)) & _u32
+        self.PC += 4
 
     def instruction_ori(self, ifield):
         'or immediate : 001101 sssss ttttt iiiiiiiiiiiiiiii : ori $t $s !i'
         self.R[ifield.t] = self.R[ifield.s] | ifield.i
+        self.PC += 4
 
     def instruction_lui(self, ifield):
         'load upper immediate : 001111 ----- ttttt iiiiiiiiiiiiiiii : lui $t !i'
         self.R[ifield.t] = ifield.i << 16
+        self.PC += 4
 
     def instruction_lw(self, ifield):
         # TODO: add "imm(addr)" format 
         'load word : 100010 sssss ttttt iiiiiiiiiiiiiiii : lw $t !i $s'
-        addr = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        addr = self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)
         self.invalid_when(addr % 4 != 0, 'lw: R[$rs]+immed must be a multiple of 4')
-        self.R[ifield.t] = self.mem_read_32bit(addr)
+        self.R[ifield.t] = self.mem_read_32bit(addr) & _u32
+        self.PC += 4
 
     def instruction_sw(self, ifield):
         # TODO: add "imm(addr)" format 
         'store word : 101011 sssss ttttt iiiiiiiiiiiiiiii : sw $t !i $s'
-        addr = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        addr = self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)
         self.invalid_when(addr % 4 != 0, 'sw: R[$rs]+immed must be a multiple of 4')
-        self.mem_write_32bit(addr, value=self.R[ifield.t])
+        self.mem_write_32bit(addr, value=sign_extend(self.R[ifield.t], 32))
+        self.PC += 4
@@ -144,7 +144,7 @@ class Assembler:
         ''' Invokes the pseudo-instruction generator for instr. '''
         iname, iops = instr[0], instr[1:]
         pseudofunc = getattr(self.isa, f'pseudo_{iname}')
-        asm = self.isa._extract_asm(pseudofunc)
+        asm = pseudofunc._asm_pattern
         asmops = asm.split()[1:]
         ifield = self.pseudo_ifield(asmops, iops)
         yield from pseudofunc(ifield)
@@ -203,8 +203,8 @@ class Assembler:
         ifunc = getattr(self.isa, f'instruction_{iname}', None)
         if ifunc is None:
             raise AssemblyError(f'Unknown instruction "{iname} {" ".join(iops)}" at line {self.current_line}.')
-        pattern = self.isa._extract_pattern(ifunc)
-        asm = self.isa._extract_asm(ifunc)
+        pattern = ifunc._bit_pattern
+        asm = ifunc._asm_pattern
         asmops = asm.split()[1:]        
         return self.machine_code_pack(pattern, asmops, iops)
 
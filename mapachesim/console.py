@@ -31,6 +31,7 @@ class MapacheConsole(cmd.Cmd):
 
     intro = 'Welcome to MapacheSIM. Type help or ? to list commands.\n'
     prompt = '(mapache) '
+    run_chunk = 10000  # max instructions simulated between checks for an interrupt
 
     def __init__(self, verbose=True):
         super().__init__()
@@ -62,8 +63,9 @@ class MapacheConsole(cmd.Cmd):
         pc = None
         try:
             while instructions_executed < max_instructions:
-                pc, ireturn = self.machine.step()
-                instructions_executed += 1
+                budget = 1 if print_each else min(self.run_chunk, max_instructions - instructions_executed)
+                executed, pc, ireturn = self.machine.run(budget, self.breakpoints)
+                instructions_executed += executed
                 if self._interrupted:
                     self._interrupted = False
                     stop_string = 'interrupted'
@@ -77,6 +79,7 @@ class MapacheConsole(cmd.Cmd):
                 elif print_each:
                     self.print_instruction(pc)
         except ExecutionError as e:
+            instructions_executed += e.instructions_executed
             pc = self.machine.PC
             stop_string = 'machine error'
             self.print_error(f'Runtime Machine Error: {e}')
@@ -90,6 +93,7 @@ class MapacheConsole(cmd.Cmd):
         '''Load a bytearray of code into instruction memory, and start up simulator.'''
         if code:
             self.machine.mem_write(self.text_start_address, code) # write code to emulated memory
+            self.machine.prefetch_decode(self.text_start_address, len(code) // self.machine.isize)
             self.machine.PC = self.text_start_address # set pc using the setter
 
     def load_data(self, data):
@@ -152,16 +152,14 @@ assert log2(4) == 2
 #-----------------------------------------------------------------------
 def sign_extend(i, bits):
     '''Sign extend a set of bits.'''
-    upper_mask = ~mask(bits)
-    if i & upper_mask != 0:
+    if __debug__ and i & ~mask(bits) != 0:
         raise MapacheError(f'upper bits of i "{i}" not 0.')
-
-    if i & (1<<(bits-1)) == 0:
-        return i
-    else:
-        return i | upper_mask
+    sign_bit = 1 << (bits-1)
+    return (i ^ sign_bit) - sign_bit
 
 assert sign_extend(0b1111,4) == -1
 assert sign_extend(0b1000,4) == -8
 assert sign_extend(0b0000,4) == 0
 assert sign_extend(0b0111,4) == 7
+assert sign_extend(0xffffffff,32) == -1
+assert sign_extend(0x7fffffff,32) == 0x7fffffff
@@ -2,11 +2,20 @@
 
 import collections
 import itertools
-import types
+import struct
 
 import assembler
 from helpers import ISADefinitionError, AssemblyError, ExecutionError
-from helpers import decimalstr_to_int
+from helpers import decimalstr_to_int, mask
+
+
+def _label_string(addr, labels):
+    '''Return "{label}" for the label at addr, or an empty string if there is none.'''
+    if labels:
+        for label, laddr in labels.items():
+            if addr == laddr:
+                return f'{{{label}}}'
+    return ''
 
 
 class  IsaDefinition:
@@ -17,15 +26,29 @@ class  IsaDefinition:
         self._pseudofuncs = [getattr(self,f) for f in dir(self) if f.startswith('pseudo_')]
         self._reg_list = []
         self._mem = {}  # a dictionary of 4k bytearrays
+        self._decode_cache = {}  # instruction word (as int) -> (ifunc, ifield)
+        self._pc_cache = {}  # instruction address -> (ifunc, ifield), for every address executed
+        self._pc_cache_range = (0, 0)  # [low, high) addresses covered by the pc cache
+        self._trace_cache = {}  # start address -> list of decoded instructions up to a branch
+        self._fetch_page_addr, self._fetch_page = None, None  # the page holding the last fetch
 
         # the parameters below are set by default but can be overridden in derived classes
         self.endian = 'big'  # can be either 'big' or 'little'
         self.isize = 4  # width of an instruction in bytes
+        self.max_trace_length = 64  # the most instructions run() will decode ahead into one trace
         self.text_start_address = 0x10000
         self.data_start_address = 0x40000
         self.assembler = assembler.Assembler(self)
+        # parse each docstring once and keep the results on the function itself
+        for ifunc in self._instrfuncs:
+            ifunc.__func__._bit_pattern = self._extract_pattern(ifunc)
+            ifunc.__func__.is_branch = getattr(ifunc, 'is_branch', False)  # set by ISAs on jumps
+        for ifunc in self._instrfuncs + self._pseudofuncs:
+            ifunc.__func__._asm_pattern = self._extract_asm(ifunc)
         # try and catch some common errors early
         self.sanity_check()
+        self._compile_patterns()
+        self._generate_decoder()
 
     def sanity_check(self):
         '''Run a series of checks for common errors in ISA specification.'''
@@ -36,13 +59,13 @@ class  IsaDefinition:
         for f in dir(self):
             if f.startswith('instruction_'):
                 func_op = f[12:]
-                def_op = self._extract_asm(getattr(self,f)).split()[0]
+                def_op = getattr(self,f)._asm_pattern.split()[0]
                 if func_op != def_op:
                     raise ISADefinitionError(f'{f} name "{func_op}" and def "{def_op}" differ.')
         # check that all bitpatterns are pairwise unique
         for f1, f2 in itertools.combinations(self._instrfuncs, 2):
-            p1 = self._extract_pattern(f1)
-            p2 = self._extract_pattern(f2)
+            p1 = f1._bit_pattern
+            p2 = f2._bit_pattern
             differ = lambda x,y: (x=='0' and y=='1') or (x=='1' and y=='0')
             differ_by_at_least_one_bit = any(differ(x,y) for x,y in zip(p1,p2))
             if not differ_by_at_least_one_bit:
@@ -55,7 +78,7 @@ class  IsaDefinition:
 
     def make_register_file(self, name, size, bits=32, rnames=None):
         '''Add a register file to the machine specification.'''
-        setattr(self, name, {x:0 for x in range(size)})
+        setattr(self, name, [0]*size)
         if rnames is None:
             rnames = {x:f'${name}{x}' for x in range(size)}
         self._reg_list.append(('file',name,bits,size,rnames))
@@ -115,16 +138,46 @@ class  IsaDefinition:
             raise ExecutionError(message)
 
     def fetch(self):
-        '''Fetch the next instruction at PC and return as an array of bytes.'''
-        return self.mem_read(self.PC, self.isize)
-
-    def decode(self, instr):
-        '''Given an instruction (as array of bytes) return its decoded form.'''
-        ifunc, ifield = self._find_pattern_match(instr)
-        if ifunc:
-            return ifunc, ifield
-        else:
-            raise ExecutionError(f'Unable to decode bytes as instruction: "{instr}".')
+        '''Fetch the next instruction at PC and return it as an integer.'''
+        page, offset = self.PC & ~0xfff, self.PC & 0xfff
+        if page != self._fetch_page_addr:
+            self.invalid_when(page not in self._mem, f'Segmentation Fault (access to unmapped page "{hex(page)}")' )
+            self._fetch_page_addr, self._fetch_page = page, self._mem[page]
+        if offset > 4096 - self.isize:
+            return self.mem_read_instruction(self.PC)  # let mem_read report the page crossing
+        # sequential fetches stay in the same page, so read it directly
+        return int.from_bytes(self._fetch_page[offset:offset+self.isize], self.endian)
+
+    def decode(self, word):
+        '''Given an instruction (as an integer) return its decoded form.'''
+        # decoding only depends on the instruction bits, so memoize by word
+        decoded_instr = self._decode_cache.get(word)
+        if decoded_instr is None:
+            ifunc, ifield = self._decoder(word)
+            if not ifunc:
+                raise ExecutionError(f'Unable to decode "{word:#0{2+2*self.isize}x}" as an instruction.')
+            decoded_instr = self._decode_cache[word] = ifunc, ifield
+        return decoded_instr
+
+    def prefetch_decode(self, start_addr, count):
+        '''Decode count instructions starting at start_addr ahead of their execution.
+           Words that do not decode (e.g. data) are skipped, and raise only if executed.'''
+        fmt = ('>' if self.endian == 'big' else '<') + {1:'B', 2:'H', 4:'I', 8:'Q'}[self.isize]
+        end_addr = start_addr + count * self.isize
+        addr = start_addr
+        while addr < end_addr:
+            # read (and unpack) up to a page of instruction words at a time
+            chunk_end = min(end_addr, (addr & ~0xfff) + 4096)
+            for (word,) in struct.iter_unpack(fmt, self.mem_read(addr, chunk_end - addr)):
+                decoded_instr = self._decode_cache.get(word)
+                if decoded_instr is None:
+                    ifunc, ifield = self._decoder(word)
+                    if ifunc:
+                        decoded_instr = self._decode_cache[word] = ifunc, ifield
+                if decoded_instr is not None:
+                    self._pc_cache[addr] = decoded_instr
+                addr += self.isize
+        self._extend_pc_cache_range(start_addr, end_addr)
 
     def execute(self, decoded_instr):
         '''Execute a decoded instruction.'''
@@ -145,20 +198,51 @@ class  IsaDefinition:
         ifunction, ifield = self._find_pattern_match(instr)
         if not ifunction:
             return None
-        asm_pattern = self._extract_asm(ifunction)
-        instr_string = self._format_asm(asm_pattern, ifield, labels)
-        return instr_string
+        return ifunction._formatter(ifield, labels)
 
     def step(self):
         '''Step the simulator forward and return any information from execution.'''
         executed_pc = self.PC
-        instr_mem = self.fetch()
-        decoded_instr = self.decode(instr_mem)
+        decoded_instr = self._pc_cache.get(executed_pc)
+        if decoded_instr is None:
+            decoded_instr = self._fetch_and_decode()
         ireturn = self.execute(decoded_instr)
         if hasattr(self,'finalize_execution'):
             self.finalize_execution(decoded_instr)
         return executed_pc, ireturn
 
+    def run(self, max_instructions, breakpoints=()):
+        '''Step the simulator forward up to max_instructions, stopping early after an instruction
+           that returns something or one that leaves the PC at a breakpoint.  Returns a triple of the
+           number of instructions executed, the pc of the last one, and what it returned.  An
+           ExecutionError raised part way through carries the count in "instructions_executed".'''
+        # this is step() fused into a loop over straight-line traces of decoded instructions,
+        # with all the lookups hoisted out of it
+        trace_cache, build_trace, execute = self._trace_cache, self._build_trace, self.execute
+        finalize_execution = getattr(self, 'finalize_execution', None)
+        isize = self.isize
+        executed, executed_pc, ireturn = 0, None, None
+        try:
+            while executed < max_instructions:
+                trace = trace_cache.get(self.PC)
+                if trace is None:
+                    trace = build_trace()
+                for decoded_instr in trace:
+                    executed_pc = self.PC
+                    ireturn = execute(decoded_instr)
+                    if finalize_execution:
+                        finalize_execution(decoded_instr)
+                    executed += 1
+                    if ireturn is not None or executed >= max_instructions or self.PC in breakpoints:
+                        return executed, executed_pc, ireturn
+                    # leave the trace if control did not fall through or the code was overwritten
+                    if self.PC != executed_pc + isize or not trace_cache:
+                        break
+        except ExecutionError as e:
+            e.instructions_executed = executed  # the ones completed before the error
+            raise
+        return executed, executed_pc, ireturn
+
     def mem_map(self, start_address, size):
         '''Map a region of physical memory into the simulator.'''
         # TODO: page size be configurable by the isa
@@ -188,6 +272,13 @@ class  IsaDefinition:
         self.invalid_when(page != end_page, f'Memory write across page boundries not supported' )
         self.invalid_when(page not in self._mem, f'Segmentation Fault (access to unmapped page "{hex(page)}")' )
         self._mem[page][offset:offset+size] = data
+        # writes over prefetched instructions make their decodings stale, so drop the
+        # entry for every instruction that overlaps [start_addr, start_addr+size)
+        low, high = self._pc_cache_range
+        if start_addr < high and start_addr + size > low:
+            for addr in range(start_addr - self.isize + 1, start_addr + size):
+                if self._pc_cache.pop(addr, None) is not None:
+                    self._trace_cache.clear()  # the instruction may be part of any trace
 
     def mem_write_64bit(self, start_addr, value):
         self.mem_write(start_addr, int.to_bytes(value, 8, self.endian, signed=True))
@@ -211,42 +302,124 @@ class  IsaDefinition:
 
     #--- private methods -------------------------------------------------------------
 
+    def _fetch_and_decode(self):
+        '''Fetch and decode the instruction at PC, remembering it in the pc cache.'''
+        decoded_instr = self.decode(self.fetch())
+        self._pc_cache[self.PC] = decoded_instr
+        self._extend_pc_cache_range(self.PC, self.PC + self.isize)
+        return decoded_instr
+
+    def _build_trace(self):
+        '''Decode the straight-line run of instructions from PC up to and including the first branch,
+           remembering it in the trace cache.'''
+        start_pc = self.PC
+        decoded_instr = self._pc_cache.get(start_pc) or self._fetch_and_decode()
+        trace, addr = [decoded_instr], start_pc
+        while not decoded_instr[0].is_branch and len(trace) < self.max_trace_length:
+            addr += self.isize
+            decoded_instr = self._pc_cache.get(addr)
+            if decoded_instr is None:
+                try:
+                    decoded_instr = self.decode(self.mem_read_instruction(addr))
+                except ExecutionError:
+                    break  # not an instruction, raise the error only if execution gets there
+                self._pc_cache[addr] = decoded_instr
+                self._extend_pc_cache_range(addr, addr + self.isize)
+            trace.append(decoded_instr)
+        self._trace_cache[start_pc] = trace
+        return trace
+
+    def _extend_pc_cache_range(self, start_addr, end_addr):
+        '''Grow the range of addresses covered by the pc cache to include [start_addr, end_addr).'''
+        low, high = self._pc_cache_range
+        if low == high:
+            self._pc_cache_range = (start_addr, end_addr)
+        else:
+            self._pc_cache_range = (min(low, start_addr), max(high, end_addr))
+
     def _extract_pattern(self, func):
         '''Extract an patterns from the instruction function docstring.'''
         # string should look like 'add immediate : 001000 sssss ttttt iiiiiiiiiii: something'
-        # TODO: this should probably be done once at initialization
         docstring = func.__doc__
         clean_format = docstring.replace(' ','').split(':')[1]
         if len(clean_format) != self.isize*8:
             raise ISADefinitionError(f'format for "{clean_format}" is {len(clean_format)} bits not {self.isize*8}.')
         return clean_format
 
-    def _find_pattern_match(self, instr):
-        '''Given an instruction (as array of bytes) find and return it's function and field.'''
+    def _compile_patterns(self):
+        '''Precompute the fixed bits and field locations of each instruction pattern.'''
+        self._compiled = []
         for ifunc in self._instrfuncs:
-            ifield = self._pattern_match(ifunc, instr)
-            if ifield is not None:
-                return ifunc, ifield
-        return None, None
+            ifunc.__func__._formatter = self._compile_formatter(ifunc._asm_pattern)
+            pattern = ifunc._bit_pattern
+            fixed_mask, fixed_value = 0, 0
+            field_runs = {}  # map field_name -> (shift, width) of its bits
+            for shift, bpattern in zip(range(len(pattern)-1, -1, -1), pattern):
+                if bpattern in '01':
+                    fixed_mask |= 1 << shift
+                    fixed_value |= int(bpattern) << shift
+                elif bpattern != '-':
+                    if bpattern not in field_runs:
+                        field_runs[bpattern] = (shift, 1)
+                    elif field_runs[bpattern][0] == shift + 1:
+                        field_runs[bpattern] = (shift, field_runs[bpattern][1] + 1)
+                    else:
+                        raise ISADefinitionError(f'field "{bpattern}" in "{pattern}" is not contiguous.')
+            # a light-weight (slotted) record type keeps the "ifield.d" interface without a dict
+            field_class = collections.namedtuple(f'{ifunc.__name__}_fields', field_runs)
+            field_extractors = [(shift, mask(width)) for shift, width in field_runs.values()]
+            self._compiled.append((ifunc, fixed_mask, fixed_value, field_class, field_extractors))
+
+        # index the patterns by the leading bits fixed in every instruction (e.g. the
+        # MIPS opcode), and within each bucket by the bits fixed in all its members
+        # (e.g. the MIPS funct field), so that decode only has to test a few candidates
+        width = self.isize*8
+        common_mask = mask(width)
+        for _, fixed_mask, _, _, _ in self._compiled:
+            common_mask &= fixed_mask
+        opcode_bits = 0
+        while opcode_bits < min(width, 8) and (common_mask >> (width-1-opcode_bits)) & 1:
+            opcode_bits += 1
+        self._opcode_shift = width - opcode_bits
+        self._by_opcode = []
+        for opcode in range(1 << opcode_bits):
+            bucket = [c for c in self._compiled if c[2] >> self._opcode_shift == opcode]
+            sub_mask = mask(self._opcode_shift) if bucket else 0
+            for _, fixed_mask, _, _, _ in bucket:
+                sub_mask &= fixed_mask
+            candidates = {}  # map (word & sub_mask) -> list of compiled patterns
+            for c in bucket:
+                candidates.setdefault(c[2] & sub_mask, []).append(c)
+            self._by_opcode.append((sub_mask, candidates))
+
+    def _generate_decoder(self):
+        '''Generate python source for a decoder specialized to the compiled patterns
+           (with every mask, compare, and shift as a constant) and exec it.'''
+        namespace = {}
+        lines = ['def decoder(word):',
+                 f'    opcode = word >> {self._opcode_shift}']
+        for opcode, (sub_mask, candidates) in enumerate(self._by_opcode):
+            if not candidates:
+                continue
+            lines.append(f'    if opcode == {opcode}:')
+            lines.append(f'        key = word & {sub_mask:#x}')
+            for key, compiled in candidates.items():
+                lines.append(f'        if key == {key:#x}:')
+                for ifunc, fixed_mask, fixed_value, field_class, field_extractors in compiled:
+                    fname, cname = ifunc.__name__, field_class.__name__
+                    namespace[fname], namespace[cname] = ifunc, field_class
+                    fields = ', '.join(f'(word >> {shift}) & {fmask:#x}' for shift, fmask in field_extractors)
+                    lines.append(f'            if word & {fixed_mask:#x} == {fixed_value:#x}:')
+                    lines.append(f'                return {fname}, {cname}({fields})')
+        lines.append('    return None, None')
+        exec('\n'.join(lines), namespace)
+        self._decoder = namespace['decoder']
 
-    def _pattern_match(self, ifunc, instr):
-        '''Check if a function docstring matches the raw bytes of instr provided, return fields or None.'''
+    def _find_pattern_match(self, instr):
+        '''Given an instruction (as array of bytes) find and return it's function and field.'''
         if len(instr) != self.isize:
             raise ISADefinitionError(f'instruction "{instr}" is {len(instr)} bytes not {self.isize}.')
-        pattern = self._extract_pattern(ifunc)
-        instr_as_integer = int.from_bytes(instr, self.endian)
-        instr_as_list_of_bits = [(instr_as_integer>>(s-1)) & 0x1 for s in range(self.isize*8,0,-1)]
-        fields = collections.defaultdict(int)
-
-        for bpattern, bit in zip(pattern, instr_as_list_of_bits):
-            if bpattern=='0' and bit==1:
-                return None
-            elif bpattern=='1' and bit==0:
-                return None
-            elif bpattern!='-':
-                fields[bpattern] = (fields[bpattern] << 1) | bit
-        ifield = types.SimpleNamespace(**fields)
-        return ifield
+        return self._decoder(int.from_bytes(instr, self.endian))
 
     def _extract_asm(self, ifunction):
         '''Given an instruction_func, return a clean asm definition from docstring.'''
@@ -255,50 +428,40 @@ class  IsaDefinition:
         monospaced_pattern = str.join(' ', clean_pattern.split())
         return monospaced_pattern
 
-    def _format_asm(self, asm_pattern, ifield, labels):
-        ''' Return a string of the pattern filled with the field data.'''
+    def _compile_formatter(self, asm_pattern):
+        '''Return a function that fills the pattern with the field data (and labels) as a string.'''
 
-        def operand_field(part, indicator):
-            # TODO much better error handling
+        def operand_field(part):
             fchar = part[1:]
-            assert len(fchar)==1
-            return getattr(ifield, fchar)
-
-        def label_string(addr):
-            if labels:
-                for label, laddr in labels.items():
-                    if addr == laddr:
-                        return f'{{{label}}}'
-            return ''
+            if len(fchar) != 1:
+                raise ISADefinitionError(f'Bad operand "{part}" in "{asm_pattern}"')
+            return f'ifield.{fchar}'
 
+        # build the source of an f-string with one replacement field per operand
         instruction = []
         for i,part in enumerate(asm_pattern.split()):
             if i==0:
                 instruction.append(part)  # instruction name
             elif part.startswith('$'):
                 # register
-                rnum = operand_field(part, '$')
-                instruction.append(f'${rnum}')
+                instruction.append(f'${{{operand_field(part)}}}')
             elif part.startswith('@'):
                 # word address
-                addr = operand_field(part, '@') << 2
-                label = label_string(addr)
-                instruction.append(f'{hex(addr)}{label}')
+                addr = f'({operand_field(part)} << 2)'
+                instruction.append(f'{{hex({addr})}}{{label_string({addr}, labels)}}')
             elif part.startswith('&'):
                 # byte address
-                addr = operand_field(part, '&')
-                instruction.append(f'{hex(addr)}')
+                instruction.append(f'{{hex({operand_field(part)})}}')
             elif part.startswith('^'):
                 # PC-relative word address (not supported yet)
-                addr = operand_field(part, '^')
-                instruction.append(f'+{hex(addr<<2)}')
+                instruction.append(f'+{{hex({operand_field(part)} << 2)}}')
             elif part.startswith('!'):
                 # immediate
-                immed = operand_field(part, '!')
-                instruction.append(f'{immed}')
+                instruction.append(f'{{{operand_field(part)}}}')
             else:
                 raise ISADefinitionError(f'Unknown operand specifier: "{part}" in "{asm_pattern}"')
-        return str.join(' ', instruction)
+        fstring = str.join(' ', instruction)
+        return eval(f'lambda ifield, labels: f{fstring!r}', {'label_string': _label_string})
 
     def _as_instruction_bytes(self, machine_code_instruction):
         '''Covert the given integer, or hex string to bytes.